@@ -1,9 +1,12 @@
-from collections import defaultdict
-from datetime import datetime
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 import json
+import os
 from pathlib import Path
 
 from datacube.utils import geometry
+import numpy as np
 from sqlalchemy.exc import SQLAlchemyError
 
 import processing
@@ -24,22 +27,31 @@ from qgis.core import (
     QgsProcessingException)
 
 from .__base__ import BaseAlgorithm
-from ..defaults import GROUP_BY_FUSE_FUNC
+from ..defaults import DASK_CHUNK_BLOCKS, GROUP_BY_FUSE_FUNC, GTIFF_DEFAULTS, WRITE_THREADS
 from ..exceptions import (NoDataError, TooManyDatasetsError)
 from ..parameters import (ParameterDateRange, ParameterProducts)
 from ..qgisutils import (get_icon)
 from ..utils import (
-    build_overviews,
     build_query,
-    calculate_statistics,
-    datetime_to_str,
-    get_products_and_measurements,
+    cached_products_and_measurements,
+    datetimes_to_str,
     run_query,
-    update_tags,
     write_geotiff
 )
 
 
+@lru_cache(maxsize=64)
+def get_crs(crs):
+    """
+    Get a cached datacube CRS, checkParameterValues is called on every parameter change
+
+    :param str crs: CRS authid, e.g. 'EPSG:4326'
+    :rtype: datacube.utils.geometry.CRS
+    :raise datacube.utils.geometry.InvalidCRSError: Invalid CRS (not cached)
+    """
+    return geometry.CRS(crs)
+
+
 class DataCubeQueryAlgorithm(BaseAlgorithm):
     """
     Class that represent a "tool" in the processing toolbox.
@@ -85,8 +97,8 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
             msgs += ['Please select two dates or none at all']
 
         if all(date_range):
-            date_range = [datetime.strptime(d, '%Y-%m-%d') for d in date_range]
-            if date_range[0] >  date_range[1]:
+            start_date, end_date = np.array(date_range, dtype='datetime64[D]')
+            if start_date > end_date:
                 msgs += ['The start date must be earlier than the end date']
 
         extent = self.parameterAsExtent(parameters, self.PARAM_EXTENT, context)  # QgsRectangle
@@ -95,11 +107,11 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
         extent_crs = None if not extent_crs else extent_crs
         # Assume 4326 if within [-180,-90,180,90] and CRS not set
         if extent_crs is None:
-            if not (extent[0] >= -180 and extent[1] >= -90 and extent[2] <= 180 and extent[3] <= 90):
+            if not np.all(np.abs(extent) <= [180, 90, 180, 90]):
                 msgs += ['Please set a valid EPSG CRS for your project/layer']
         else:
             try:
-                geometry.CRS(extent_crs)
+                get_crs(extent_crs)
             except geometry.InvalidCRSError:
                 msgs += ['Please set a valid EPSG CRS for your project/layer']
 
@@ -109,7 +121,7 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
             if not output_res:
                 msgs += ['Please specify "Output Resolution" when specifying "Output CRS"']
             try:
-                geometry.CRS(output_crs.authid())
+                get_crs(output_crs.authid())
             except geometry.InvalidCRSError:
                 msgs += ['Please set a valid EPSG "Output CRS"']
 
@@ -142,7 +154,7 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
 
     def get_products_and_measurements(self):
         config_file = self.get_settings()['datacube_config_file'] or None
-        return get_products_and_measurements(config=config_file)
+        return cached_products_and_measurements(config=config_file)
 
     def group(self):
         """
@@ -231,14 +243,17 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
         overviews = settings['datacube_build_overviews']
         calc_stats = settings['datacube_calculate_statistics']
         approx_ok = settings['datacube_approx_statistics']
+        quantize = settings['datacube_quantize']
+        try:
+            write_threads = int(settings['datacube_write_threads'])
+        except (TypeError, ValueError):
+            write_threads = WRITE_THREADS
 
         # Parameters
         product_descs = self.parameterAsString(parameters, self.PARAM_PRODUCTS, context)
         product_descs = json.loads(product_descs)
-        products = defaultdict(list)
-        for k, v in product_descs.items():
-            for m in v:
-                products[self.products[k]['product']] += [self.products[k]['measurements'][m]]
+        products = {self.products[k]['product']: [self.products[k]['measurements'][m] for m in v]
+                    for k, v in product_descs.items()}
 
         date_range = self.parameterAsString(parameters, self.PARAM_DATE_RANGE, context)
         date_range = json.loads(date_range)
@@ -264,14 +279,16 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
 
         processing.mkdir(output_folder)
 
-        dask_chunks = {'time': 1} if date_range is not None else None
+        # Load lazily in row chunks aligned to the GeoTIFF blocks so outputs are written a chunk at a time
+        blockysize = {k.lower(): v for k, v in gtiff_options.items()}.get('blockysize', GTIFF_DEFAULTS['blockysize'])
+        dask_chunks = {'time': 1, 'y': blockysize * DASK_CHUNK_BLOCKS}
 
         output_layers = self.execute(
             products, date_range, extent, extent_crs,
             output_crs, output_res, output_folder,
-            config_file, dask_chunks, overviews, calc_stats, approx_ok,
+            config_file, dask_chunks, overviews, calc_stats, approx_ok, quantize,
             gtiff_options, gtiff_ovr_options,
-            group_by, fuse_func, max_datasets, feedback)
+            group_by, fuse_func, max_datasets, write_threads, feedback)
 
         results = {self.OUTPUT_FOLDER: output_folder, self.OUTPUT_LAYERS: output_layers.keys()}
         self.outputs = output_layers # This is used in postProcessAlgorithm
@@ -281,9 +298,9 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
     def execute(self,
                 products, date_range, extent, extent_crs,
                 output_crs, output_res, output_folder,
-                config_file, dask_chunks, overviews, calc_stats, approx_ok,
+                config_file, dask_chunks, overviews, calc_stats, approx_ok, quantize,
                 gtiff_options, gtiff_ovr_options,
-                group_by, fuse_func, max_datasets, feedback):
+                group_by, fuse_func, max_datasets, write_threads, feedback):
 
         output_layers = {}
         progress_total = 100 / (10*len(products))
@@ -315,38 +332,61 @@ class DataCubeQueryAlgorithm(BaseAlgorithm):
                 feedback.setProgress(int((idx + 1) * 10 * progress_total))
                 continue
 
-            basename = '{}_{}'.format(product, '{}')
-            basepath = str(Path(output_folder, basename))
-
-            feedback.setProgressText('Saving outputs for {}'.format(product))
-            for i, dt in enumerate(data.time):
-                if group_by is None:
-                    ds = datetime_to_str(dt.data, '%Y-%m-%d_%H-%M-%S')
-                    tag = datetime_to_str(dt.data, '%Y:%m:%d %H:%M:%S')
-                else:
-                    ds = datetime_to_str(dt.data)
-                    tag = datetime_to_str(dt.data, '%Y:%m:%d')
-
-                raster_path = basepath.format(ds) + '.tif'
-
-                write_geotiff(data, raster_path, time_index=i,
-                              profile_override=gtiff_options, overwrite=True)
-
-                update_tags(raster_path, TIFFTAG_DATETIME=tag)
+            prefix = str(Path(output_folder, product)) + '_'
 
-                if overviews:
-                    build_overviews(raster_path, gtiff_ovr_options)
+            # Format all timesteps at once, e.g. '2001-12-31_01-23-45' & '2001:12:31 01:23:45'
+            isodates = datetimes_to_str(data.time.values, 's' if group_by is None else 'D')
+            dates = np.char.replace(np.char.replace(isodates, 'T', '_'), ':', '-').tolist()
+            tags = np.char.replace(np.char.replace(isodates, '-', ':'), 'T', ' ').tolist()
 
-                if calc_stats:
-                    calculate_statistics(raster_path, approx_ok)
-
-                lyr_name = basename.format(ds)
-                output_layers[raster_path] = lyr_name
+            feedback.setProgressText('Saving outputs for {}'.format(product))
 
-                feedback.setProgress(int((idx * 10 + i + 1) * progress_total))
+            # Timesteps are written to independent files and dask/rasterio release the GIL,
+            # so write them concurrently, sharing the CPUs between the dask/GDAL threads of each write.
+            # Each write holds a whole timestep in memory, so the number of concurrent writes is a setting.
+            cpu_count = os.cpu_count() or 1
+            max_workers = max(1, min(write_threads, cpu_count, len(dates)))
+            num_threads = max(1, cpu_count // max_workers)
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = OrderedDict()
+                for i, (ds, tag) in enumerate(zip(dates, tags)):
+                    raster_path = prefix + ds + '.tif'
+                    future = executor.submit(
+                        write_geotiff, data, raster_path, time_index=i,
+                        profile_override=gtiff_options, overwrite=True,
+                        tags={'TIFFTAG_DATETIME': tag},
+                        overviews=overviews, overview_options=gtiff_ovr_options,
+                        calc_stats=calc_stats, approx_ok=approx_ok, quantize=quantize,
+                        num_threads=num_threads)
+                    futures[future] = (raster_path, product + '_' + ds)
+
+                # Only emit the (Qt signal) progress when the integer percentage changes
+                progress = [int((idx * 10 + i + 1) * progress_total) for i in range(len(futures))]
+                last_progress = -1
+
+                try:
+                    for i, future in enumerate(as_completed(futures)):
+                        future.result()  # Reraise any exceptions
+
+                        if progress[i] != last_progress:
+                            feedback.setProgress(progress[i])
+                            last_progress = progress[i]
+
+                        if feedback.isCanceled():
+                            break
+                finally:
+                    # Don't start queued timesteps after an error or cancel
+                    for f in futures:
+                        f.cancel()
+
+            # Keep layers in time order rather than completion order
+            for future, (raster_path, lyr_name) in futures.items():
+                if not future.cancelled() and future.exception() is None:
+                    output_layers[raster_path] = lyr_name
 
-                if feedback.isCanceled():
-                    return output_layers
+            if feedback.isCanceled():
+                return output_layers
 
             feedback.setProgress(int((idx + 1) * 10 * progress_total))
 
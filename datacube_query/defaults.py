@@ -11,7 +11,7 @@ GTIFF_OVR_RESAMPLING = {r.name: r for r in Resampling}
 
 
 GTIFF_DEFAULTS = {"driver": "GTiff",
-                  "interleave": "band", "tiled": True,
+                  "interleave": "pixel", "tiled": True,
                   "blockxsize": 256, "blockysize": 256,
                   "compress": "lzw", "predictor": 1,
                   "tfw": False, "jpeg_quality": 75,
@@ -21,10 +21,22 @@ GTIFF_DEFAULTS = {"driver": "GTiff",
                   'photometric': 'RGBA',
                   }
 
+# rasterio resampling names supported by the COG driver OVERVIEW_RESAMPLING option
+COG_OVR_RESAMPLING = {'nearest': 'NEAREST', 'average': 'AVERAGE', 'bilinear': 'BILINEAR',
+                      'cubic': 'CUBIC', 'cubic_spline': 'CUBICSPLINE', 'lanczos': 'LANCZOS',
+                      'mode': 'MODE', 'rms': 'RMS'}
+
 GTIFF_OVR_DEFAULTS = {'resampling': 'average',
                       'factors': [2, 4, 8, 16, 32],
                       'internal_storage': True}
 
+# GDAL config options used when writing, lets GDAL compress and build overviews using all cores
+GDAL_WRITE_OPTIONS = {'GDAL_NUM_THREADS': 'ALL_CPUS',
+                      'CHECK_DISK_FREE_SPACE': False}
+
+WRITE_THREADS = 2  # Default number of timesteps to write concurrently
+DASK_CHUNK_BLOCKS = 8  # Number of GeoTIFF block rows loaded and written at a time
+
 GROUP_BY_FUSE_FUNC = OrderedDict(
     [
         ('Solar Day', ('solar_day', None)), #default in datacube-qgis
@@ -6,7 +6,8 @@ from processing.core.ProcessingConfig import ProcessingConfig, Setting
 from .algs.query import DataCubeQueryAlgorithm
 
 from .qgisutils import get_icon
-from .defaults import (GTIFF_OVR_DEFAULTS, GTIFF_DEFAULTS, SETTINGS_GROUP)
+from .utils import cached_products_and_measurements
+from .defaults import (GTIFF_OVR_DEFAULTS, GTIFF_DEFAULTS, SETTINGS_GROUP, WRITE_THREADS)
 
 
 class DataCubeQueryProvider(QgsProcessingProvider):
@@ -64,6 +65,16 @@ class DataCubeQueryProvider(QgsProcessingProvider):
                     self.tr("7. Statistics will be calculated approximately (faster)"),
                     default=True,
                     valuetype=None),
+            Setting(SETTINGS_GROUP,
+                    'datacube_quantize',
+                    self.tr("8. Quantize outputs to int16 where possible"),
+                    default=False,
+                    valuetype=None),
+            Setting(SETTINGS_GROUP,
+                    'datacube_write_threads',
+                    self.tr("9. Number of timesteps to write concurrently"),
+                    default=WRITE_THREADS,
+                    valuetype=Setting.INT),
         ]
 
         ProcessingConfig.settingIcons[DataCubeQueryProvider.NAME] = self.icon()
@@ -92,5 +103,7 @@ class DataCubeQueryProvider(QgsProcessingProvider):
         return DataCubeQueryProvider.ID
 
     def loadAlgorithms(self):
+        # Reloading the provider (e.g. after changing settings) picks up newly indexed products
+        cached_products_and_measurements.cache_clear()
         for alg in self.algs:
             self.addAlgorithm(alg())
@@ -1,19 +1,26 @@
 from collections import defaultdict
+from copy import deepcopy
 from datetime import datetime
+from functools import lru_cache
+import os
 
 import dask.array as da
 import numpy as np
-from osgeo import gdal  # rasterio can't calc stats... - https://github.com/mapbox/rasterio/issues/244
-import pandas as pd
 from pathlib import Path
 import rasterio as rio
 from rasterio.dtypes import check_dtype
+from rasterio.env import GDALVersion
+from rasterio.windows import Window
 
 import datacube
 from datacube.api.query import Query
+from datacube.config import DEFAULT_CONF_PATHS
 from datacube.helpers import write_geotiff as _write_geotiff
+from datacube.utils import geometry
 
 from .defaults import (
+    COG_OVR_RESAMPLING,
+    GDAL_WRITE_OPTIONS,
     GTIFF_OVR_DEFAULTS,
     GTIFF_DEFAULTS,
     GTIFF_OVR_RESAMPLING)
@@ -22,36 +29,6 @@ from .exceptions import (
     TooManyDatasetsError)
 
 
-def build_overviews(filename, overview_options=None):
-    """
-    Build reduced resolution overviews/pyramids for a raster
-
-    :param filename: The raster to build overviews for.
-    :type filename: str
-
-    :param overview_options: Overview options.
-    :type overview_options: dict.
-        Example:
-
-            {"resampling": "average", "factors": [2, 4, 8, 16, 32], "internal_storage": True}
-
-    """
-
-    options = GTIFF_OVR_DEFAULTS.copy()
-    if overview_options is not None:
-        options.update(overview_options)
-    if options['internal_storage']:
-        mode = 'r+'
-    else:
-        mode = 'r'
-
-    resampling = GTIFF_OVR_RESAMPLING[options['resampling']]
-
-    with rio.open(filename, mode) as raster:
-        raster.build_overviews(options['factors'], resampling)
-        raster.update_tags(ns='rio_overview', resampling=options['resampling'])
-
-
 def build_query(
         product, measurements, date_range, extent,
         query_crs, output_crs=None, output_res=None,
@@ -97,28 +74,87 @@ def build_query(
     return query
 
 
-def calculate_statistics(filepath, approx_ok=True):
+def cached_products_and_measurements(config=None):
     """
-    Calculate min,max,mean,std
+    Get a cached dict of products and measurements.
 
-    :param str filepath:
-    :param bool approx_ok: Use faster approximate stats
-    :return: Dataset statistics, nested lists of per band stats
-             [[min, max, mean, std], [min, max, mean, std], etc...]
-    :rtype: list[list[float]]
+    The cache is keyed by the config file paths datacube reads (`config`, or `DATACUBE_CONFIG_PATH`
+    or the default locations if `config` is None) and their modification times,
+    so editing or changing the config file refreshes the products.
+    Use `cached_products_and_measurements.cache_clear()` to pick up newly indexed products.
+
+    :param str config: Datacube config filepath or None.
+    :type config: str or None.
+
+    :return: A dict of products and measurements, see :func:`get_products_and_measurements`.
+    :rtype: dict
     """
-    gdal.UseExceptions()
-    try:
-        ds = gdal.OpenEx(filepath, gdal.GA_Update)
-    except AttributeError:  # gdal <= 2.0 (gdal.Open works but is deprecated in 2.x)
-        ds = gdal.Open(filepath, gdal.GA_Update)
 
-    stats = []
-    for i in range(ds.RasterCount):
-        stats.append(ds.GetRasterBand(i + 1).ComputeStatistics(approx_ok))
-    del ds
+    if config is not None:
+        paths = [config]
+    elif 'DATACUBE_CONFIG_PATH' in os.environ:
+        paths = [os.environ['DATACUBE_CONFIG_PATH']]
+    else:
+        paths = DEFAULT_CONF_PATHS
+
+    mtimes = []
+    for path in paths:
+        path = os.path.abspath(os.path.expanduser(path))
+        try:
+            mtimes.append((path, os.path.getmtime(path)))
+        except OSError:  # datacube skips missing config files too
+            pass
+
+    # Copy so callers can't modify the cached products
+    return deepcopy(_cached_products_and_measurements(config, tuple(mtimes)))
+
+
+@lru_cache(maxsize=4)
+def _cached_products_and_measurements(config, mtimes):
+    products = get_products_and_measurements(config=config)
+    return {desc: {'product': prod['product'], 'measurements': dict(prod['measurements'])}
+            for desc, prod in products.items()}
+
+
+cached_products_and_measurements.cache_clear = _cached_products_and_measurements.cache_clear
+
+
+def cog_profile(profile, overview_options, overviews=True):
+    """
+    Convert a GTiff profile to a Cloud Optimized GeoTIFF (COG driver) profile
+
+    The COG driver always builds power of 2 internal overviews, so only the number
+    of overview factors is used, e.g. [2, 4, 8] gives 3 levels.
+
+    :param dict profile: GTiff rasterio profile (lowercase keys).
+    :param dict overview_options: Overview options, e.g.
+        {"resampling": "average", "factors": [2, 4, 8, 16, 32], "internal_storage": True}
+    :param bool overviews: Build overviews.
+
+    :return: COG rasterio profile.
+    :rtype: dict
+
+    :raise KeyError: Overview resampling method not supported by the COG driver
+    """
+
+    keep = ('width', 'height', 'transform', 'crs', 'count', 'nodata', 'dtype', 'predictor', 'bigtiff')
+    cog = {k: v for k, v in profile.items() if k in keep}
+    cog.update({
+        'driver': 'COG',
+        'compress': profile.get('compress', 'DEFLATE'),
+        'blocksize': profile.get('blockxsize', 512),  # Overviews use the full res blocksize
+    })
+
+    if overviews:
+        cog.update({
+            'overviews': 'AUTO',
+            'overview_count': len(overview_options['factors']),  # GDAL >= 3.6
+            'overview_resampling': COG_OVR_RESAMPLING[overview_options['resampling']],
+        })
+    else:
+        cog['overviews'] = 'NONE'
 
-    return stats
+    return cog
 
 
 def datetime_to_str(datetime64, str_format='%Y-%m-%d'):
@@ -140,6 +176,20 @@ def datetime_to_str(datetime64, str_format='%Y-%m-%d'):
     return dt.strftime(str_format)
 
 
+def datetimes_to_str(datetime64s, unit='s'):
+    """
+    Convert an array of numpy.datetime64 to ISO 8601 strings in one vectorised call
+
+    :param numpy.ndarray datetime64s: Array of datetime64 values.
+    :param str unit: Datetime unit to format to, e.g. 's' or 'D'.
+
+    :return: Array of strings, e.g. ['2001-12-31T01:23:45'] or ['2001-12-31'].
+    :rtype: numpy.ndarray
+    """
+
+    return np.datetime_as_string(datetime64s, unit=unit)
+
+
 def get_dtype(dataset):
     try:
         dtypes = {val.dtype for val in dataset.data_vars.values()}
@@ -199,24 +249,16 @@ def get_products_and_measurements(config=None):
     proddict = defaultdict(lambda: defaultdict(dict))
 
     dc = datacube.Datacube(config=config)
-    products = dc.list_products()
-    measurements = dc.list_measurements()
-    measurements.reset_index(inplace=True)
-    display_columns = ['name', 'description']
-    products = products[display_columns]
-    display_columns = ['measurement', 'aliases', 'product']
-    measurements = measurements[display_columns]
-
-    products.set_index(['name'], inplace=True, drop=False)
-    measurements.set_index(['product'], inplace=True, drop=False)
-
-    prodmeas = measurements.join(products, how='left')
-    prodmeas['meas_desc'] = prodmeas[['measurement', 'aliases']].apply(lambda x: measurement_desc(*x), axis=1)
+    for product in dc.index.products.get_all():
+        if not product.measurements:
+            continue
 
-    for row in prodmeas.itertuples():
-        description = '{} ({})'.format(row.description, row.name) if row.description else row.name
-        proddict[description]['product'] = row.product
-        proddict[description]['measurements'][row.meas_desc] = row.measurement
+        description = product.definition.get('description')
+        description = '{} ({})'.format(description, product.name) if description else product.name
+        proddict[description]['product'] = product.name
+        for name, measurement in product.measurements.items():
+            meas_desc = measurement_desc(name, measurement.get('aliases'))
+            proddict[description]['measurements'][meas_desc] = name
 
     return proddict
 
@@ -244,30 +286,105 @@ def measurement_desc(measurement, aliases, brackets=False):
     Generate measurement descriptions from measurement name and aliases.
 
     :param str measurement: Measurement name.
-    :param list aliases: List of aliases or NaN.
+    :param list aliases: List of aliases, None or NaN.
 
     :rtype: str
     """
-    try:
-        if pd.isnull(aliases):
-            return measurement
-    except ValueError:  # Got a list
-        pass
+    if not isinstance(aliases, (list, tuple)):
+        return measurement
 
-    if measurement in aliases:  # Assumes a list...
-        del aliases[aliases.index(measurement)]
+    aliases = [alias for alias in aliases if alias != measurement]
 
     if brackets:
         return '{} ({})'.format(measurement, '/'.join(aliases))
     else:
-        return '/'.join([measurement]+aliases)  # Assumes a list...
+        return '/'.join([measurement]+aliases)
+
+
+def quantize_dataset(dataset, dtype='int16'):
+    """
+    Quantize measurements to a smaller integer dtype using their scale_factor/add_offset attrs.
+
+    Every data variable must have a `valid_range` attr (in the units of the loaded data) that fits
+    in `dtype` once scaled. Float data also needs a `scale_factor` (`add_offset` defaults to 0),
+    integer data is assumed to already be scaled and is only downcast.
+
+    Values are clipped to the valid range. NaNs and nodata are written as a single nodata value
+    for all bands (GeoTIFFs only have one), which is the source nodata if all bands share it and it's
+    outside every valid range, otherwise the dtype min or max.
+
+    :param xarray.Dataset dataset: Dataset to quantize.
+    :param dtype: Integer data type object or string to quantize to.
+    :type dtype: Union(numpy.dtype, str)
+    :return: Tuple of quantized Dataset, per band scales and per band offsets,
+             or None if the dataset can't be quantized
+    :rtype: Union(tuple(xarray.Dataset, list[float], list[float]), None)
+    """
+
+    dtype = np.dtype(dtype)
+    info = np.iinfo(dtype)
+
+    bands = []
+    for var, data in dataset.data_vars.items():
+        valid_range = data.attrs.get('valid_range')
+        scale = data.attrs.get('scale_factor')
+        offset = data.attrs.get('add_offset', 0)
+
+        if valid_range is None or data.dtype.itemsize <= dtype.itemsize:
+            return None
+
+        if data.dtype.kind == 'f':
+            if scale is None:
+                return None
+            valid_range = np.round((np.asarray(valid_range) - offset) / scale)
+            quantized = ((data - offset) / scale).round()
+        else:
+            quantized = data
+
+        vmin, vmax = np.min(valid_range), np.max(valid_range)
+        if vmin < info.min or vmax > info.max:
+            return None
+
+        bands.append((var, data, quantized, vmin, vmax, scale, offset))
+
+    # Pick one nodata value outside the valid range of every band
+    vmin = min(band[3] for band in bands)
+    vmax = max(band[4] for band in bands)
+    nodatavals = {get_nodata(band[1]) for band in bands}
+    nodata = nodatavals.pop() if len(nodatavals) == 1 else None
+    if nodata is not None and not np.isnan(nodata) and info.min <= nodata <= info.max \
+            and not vmin <= nodata <= vmax:
+        packed_nodata = nodata
+    elif vmin > info.min:
+        packed_nodata = info.min
+    elif vmax < info.max:
+        packed_nodata = info.max
+    else:
+        return None  # No room for nodata
+
+    scales, offsets, data_vars = [], [], {}
+    for var, data, quantized, vmin, vmax, scale, offset in bands:
+        mask = data.isnull()
+        if get_nodata(data) is not None:
+            mask |= data == get_nodata(data)
+        quantized = quantized.clip(vmin, vmax).where(~mask, packed_nodata)
+
+        data_vars[var] = quantized.astype(dtype)
+        data_vars[var].attrs = dict(data.attrs, nodata=packed_nodata)
+        scales.append(1 if scale is None else scale)
+        offsets.append(offset)
+
+    dataset = dataset.assign(data_vars)
+
+    return dataset, scales, offsets
 
 
 def run_query(query, config=None, max_datasets=None):
     """
     Load and return the data.
 
-    :param dict query: Query.
+    :param dict query: Query. A 'y' key in `dask_chunks` is applied to the output y dimension,
+                       i.e. 'y' or 'latitude' depending on the output CRS.
     :param str config: Datacube config filepath or None.
 
     :return: Data.
@@ -280,9 +397,9 @@ def run_query(query, config=None, max_datasets=None):
     # noinspection PyTypeChecker
     dc = datacube.Datacube(config=config, app='QGIS Plugin')
 
-    test_query = {k: query[k] for k in ('product', 'time', 'x', 'y', 'crs') if k in query}
-    test_query = Query(**test_query)
-    datasets = dc.index.datasets.search_eager(**test_query.search_terms)
+    search_terms = {k: query[k] for k in ('product', 'time', 'x', 'y', 'crs') if k in query}
+    Query(**search_terms)  # Validate the query client side, e.g. raise InvalidCRSError
+    datasets = dc.find_datasets(ensure_location=True, **search_terms)  # dc.load defaults to ensure_location=True
 
     if not datasets:
         raise NoDataError('No datasets found for query:\n{}'.format(str(query)))
@@ -291,7 +408,16 @@ def run_query(query, config=None, max_datasets=None):
                'Reduce your temporal or spatial extent, or increase the maximum in Settings.')
         raise TooManyDatasetsError(msg.format(len(datasets), max_datasets))
 
-    data = dc.load(**query)
+    dask_chunks = query.get('dask_chunks')
+    if dask_chunks and 'y' in dask_chunks:
+        # Rename the y chunks to the output y dimension, e.g. 'latitude' for geographic CRSs
+        crs = query.get('output_crs') or datasets[0].crs
+        crs = crs if isinstance(crs, geometry.CRS) else geometry.CRS(crs)
+        dask_chunks = dict(dask_chunks)
+        dask_chunks[crs.dimensions[0]] = dask_chunks.pop('y')
+        query = dict(query, dask_chunks=dask_chunks)
+
+    data = dc.load(datasets=datasets, **query)  # Reuse the datasets found, avoids a second index search
 
     if not data.variables:
         raise NoDataError('No data found for query:\n{}'.format(str(query)))
@@ -313,35 +439,15 @@ def upcast(dataset, old_dtype):
     old_dtype = np.dtype(old_dtype)  # Ensure old dtype is an np.dtype instance (i.e. not a string)
     dtype = np.dtype(old_dtype.kind + str(old_dtype.itemsize * 2))
 
-    # dataset.astype strips attrs, so save them
-    dataset_attrs = dataset.attrs
-    datavar_attrs = {var: val.attrs for var, val in dataset.data_vars.items()}
-
-    # Upcast
-    dataset = dataset.astype(dtype)  # loses attrs
-
-    # Re-add attrs
-    dataset.attrs.update(**dataset_attrs)
-    for var, val in dataset.data_vars.items():
-        val.attrs.update(**datavar_attrs[var])
+    # Lazy for dask backed datasets, so the cast is fused into the existing graph
+    dataset = dataset.astype(dtype, keep_attrs=True)
 
     return dataset, dtype
 
 
-def update_tags(filename, bidx=0, ns=None, **tags):
-    """
-    Update raster metadata tags.
-
-    :param str filename: Raster to update.
-    :param bidx: Index of band to be updated.
-    :param str ns: Namespace
-    :param dict tags: tags to update
-    """
-    with rio.open(filename, 'r+') as raster:
-        raster.update_tags(bidx=bidx, ns=ns, **tags)
-
-
-def write_geotiff(dataset, filename, time_index=None, profile_override=None, overwrite=False):
+def write_geotiff(dataset, filename, time_index=None, profile_override=None, overwrite=False,
+                  tags=None, overviews=False, overview_options=None, calc_stats=False, approx_ok=True,
+                  quantize=False, num_threads=None):
     """
     Write an xarray dataset to a geotiff
         Modified from datacube.helpers.write_geotiff to support:
@@ -352,6 +458,7 @@ def write_geotiff(dataset, filename, time_index=None, profile_override=None, ove
             - Nodata values
             - dtype checks and upcasting
             - existing output checks
+            - tags, overviews and statistics written in the same rasterio session
         https://github.com/opendatacube/datacube-core/blob/develop/datacube/helpers.py
         Original code licensed under the Apache License, Version 2.0 (the "License");
 
@@ -360,6 +467,14 @@ def write_geotiff(dataset, filename, time_index=None, profile_override=None, ove
     :param int time_index: time index to write to file
     :param dict profile_override: option dict, overrides rasterio file creation options.
     :param bool overwrite: Allow overwriting existing files.
+    :param dict tags: Dataset metadata tags to write, e.g. {'TIFFTAG_DATETIME': '2001:12:31'}
+    :param bool overviews: Build reduced resolution overviews/pyramids.
+    :param dict overview_options: Overview options, e.g.
+        {"resampling": "average", "factors": [2, 4, 8, 16, 32], "internal_storage": True}
+    :param bool calc_stats: Calculate band statistics.
+    :param bool approx_ok: Use faster approximate stats
+    :param bool quantize: Quantize to int16 where possible, see :func:`quantize_dataset`.
+    :param int num_threads: Number of dask and GDAL threads to use, defaults to all CPUs.
 
     """
 
@@ -378,7 +493,14 @@ def write_geotiff(dataset, filename, time_index=None, profile_override=None, ove
     if time_index is not None:
         dataset = dataset.isel(time=time_index)
 
-    profile = lcase_dict(GTIFF_DEFAULTS.copy())  # Sanitise user modifiable values
+    scales = offsets = None
+    if quantize:
+        quantized = quantize_dataset(dataset)
+        if quantized is not None:
+            dataset, scales, offsets = quantized
+            dtype = get_dtype(dataset)
+
+    profile = GTIFF_DEFAULTS.copy()
 
     geobox = getattr(dataset, 'geobox', None)
     if geobox is None:
@@ -420,10 +542,62 @@ def write_geotiff(dataset, filename, time_index=None, profile_override=None, ove
         profile.pop('blockxsize', None)
         profile.pop('blockysize', None)
 
-    with rio.Env():
+    # Write one dask chunk of rows at a time, slicing within a chunk would recompute the whole chunk.
+    ydim = geobox.dimensions[0]
+    try:
+        row_heights = dataset.chunks.get(ydim, (height,))
+    except ValueError:  # Inconsistent chunks between variables
+        row_heights = (height,)
+
+    ovr_options = GTIFF_OVR_DEFAULTS.copy()
+    if overview_options is not None:
+        ovr_options.update(overview_options)
+
+    # Cloud Optimized GeoTIFFs are only written if explicitly requested with "driver": "COG".
+    # The COG driver can't stream, rasterio buffers the whole raster in memory and
+    # copies it to the output file (building overviews) when it is closed.
+    # Fall back to GTiff if GDAL < 3.6 (no OVERVIEW_COUNT) or the resampling method isn't supported by COG
+    cog = profile['driver'].lower() == 'cog'
+    if cog and (not GDALVersion.runtime().at_least('3.6') or
+                overviews and ovr_options['resampling'] not in COG_OVR_RESAMPLING):
+        profile['driver'] = 'GTiff'
+        cog = False
+    if cog:
+        profile = cog_profile(profile, ovr_options, overviews)
+
+    gdal_options = GDAL_WRITE_OPTIONS.copy()
+    if num_threads is not None:
+        gdal_options['GDAL_NUM_THREADS'] = num_threads
+
+    # TIFF_USE_OVR forces external (.ovr) overviews
+    with rio.Env(TIFF_USE_OVR=not ovr_options['internal_storage'], GDAL_TIFF_INTERNAL_MASK=True,
+                 **gdal_options):
         with rio.open(str(filename), 'w', sharing=False, **profile) as dest:
             if hasattr(dataset, 'data_vars'):
-                for bandnum, data in enumerate(dataset.data_vars.values(), start=1):
-                    if hasattr(data, 'compute'):
-                        data = data.compute()
-                    dest.write(data.values, bandnum)
+                row = 0
+                for row_height in row_heights:
+                    # Compute all bands in one dask graph so shared chunks are only read once
+                    slab = dataset.isel(**{ydim: slice(row, row + row_height)})
+                    slab = slab.compute(scheduler='threads', num_workers=num_threads)
+                    # and write them in one call, i.e. (bands, rows, cols), rather than band by band
+                    slab = np.stack([data.values for data in slab.data_vars.values()]).astype(dtype, copy=False)
+                    dest.write(slab, window=Window(0, row, width, row_height))
+                    row += row_height
+                dest.descriptions = tuple(dataset.data_vars.keys())
+
+            if scales is not None:  # Written to GDAL metadata and applied by GDAL/QGIS when reading
+                dest.scales = scales
+                dest.offsets = offsets
+
+            if tags:
+                dest.update_tags(**tags)
+
+            if overviews:
+                if not cog:  # COG driver builds overviews when the file is closed
+                    resampling = GTIFF_OVR_RESAMPLING[ovr_options['resampling']]
+                    dest.build_overviews(ovr_options['factors'], resampling)
+                dest.update_tags(ns='rio_overview', resampling=ovr_options['resampling'])
+
+            if calc_stats:
+                for bidx in dest.indexes:
+                    dest.statistics(bidx, approx=approx_ok)
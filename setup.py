@@ -69,8 +69,8 @@ def main():
         'dask[array]',
         'numpy',
         'pandas',
-        'rasterio>=0.9a10',  # required for zip reading, 0.9 gets around 1.0a ordering problems
-        'xarray>=0.9',  # >0.9 fixes most problems with `crs` attributes being lost
+        'rasterio>=1.3',  # required for DatasetBase.statistics
+        'xarray>=0.16.1',  # required for Dataset.astype(keep_attrs=...)
     ]
 
     tests_require = ['pytest'] + install_requires
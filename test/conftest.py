@@ -3,16 +3,10 @@ import pytest
 from contextlib import contextmanager
 import os
 from osgeo import gdal
-from pathlib import Path
 from datetime import datetime
 import numpy as np
 
 
-@pytest.fixture
-def data_path():
-    return Path(Path(__file__).parent, 'data').absolute()
-
-
 @pytest.fixture
 def environ():
     @contextmanager
@@ -1,36 +1,19 @@
 import pytest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 from datetime import datetime
+import os
 import tempfile
-import shutil
 from pathlib import Path
 
 import datacube
 import numpy as np
-import pandas as pd
 import rasterio as rio
 import xarray as xr
 
 import datacube_query.utils
 
 
-def test_build_overviews(data_path):
-    without_ovr = Path(data_path,'test_without_ovr.tif')
-    with_ovr = Path(data_path, 'test_with_ovr.tif')
-
-    with tempfile.TemporaryDirectory() as tempdir:
-        tmp_raster = Path(tempdir, without_ovr.name)
-        # noinspection PyTypeChecker
-        shutil.copy(without_ovr, tmp_raster)
-        datacube_query.utils.build_overviews(str(tmp_raster))
-
-        with rio.open(str(tmp_raster)) as test_raster, rio.open(str(with_ovr)) as known_raster:
-            test_checksums = [test_raster.checksum(i) for i in test_raster.indexes]
-            known_checksums = [known_raster.checksum(i) for i in known_raster.indexes]
-            assert test_checksums == known_checksums  # [14157, 14592, 14233]
-
-
 def test_build_query():
     known_query = {'product': 'tma', 'measurements': ['1', '4', '9'],
                    'x': (19680402.0, 19680205.0), 'y': (-19680205.0, -19680402.0),
@@ -43,21 +26,54 @@ def test_build_query():
     assert known_query == test_query
 
 
-def test_calculate_statistics(data_path, shut_gdal_up):
-    with pytest.raises(Exception), shut_gdal_up:
-        datacube_query.utils.calculate_statistics('foo')
+@patch('datacube_query.utils.get_products_and_measurements')
+def test_cached_products_and_measurements(mock_get_products, environ):
+    datacube_query.utils.cached_products_and_measurements.cache_clear()
 
-    filepath = Path(data_path,'test_without_ovr.tif')
     with tempfile.TemporaryDirectory() as tempdir:
-        tmp_raster = Path(tempdir, filepath.name)
-        # noinspection PyTypeChecker
-        shutil.copy(filepath, tmp_raster)
-        expected = np.array([
-            [148.0, 1184.0, 294.232, 94.750],
-            [258.0, 1479.0, 500.683, 150.116],
-            [208.0, 1615.0, 493.837, 164.319]])
-        got = np.array(datacube_query.utils.calculate_statistics(str(tmp_raster)))
-        assert np.allclose(got, expected)
+        config = Path(tempdir, 'datacube.conf')
+        config.write_text('[datacube]')
+        os.utime(str(config), (0, 0))
+
+        mock_get_products.return_value = {'Some Dataset': {'product': 'some_dataset', 'measurements': {}}}
+        products = datacube_query.utils.cached_products_and_measurements(str(config))
+        products['Not a Dataset'] = {}
+        products = datacube_query.utils.cached_products_and_measurements(str(config))
+        assert mock_get_products.call_count == 1
+        assert 'Not a Dataset' not in products  # Cached products can't be modified
+
+        os.utime(str(config), (1, 1))  # Config changed
+        datacube_query.utils.cached_products_and_measurements(str(config))
+        assert mock_get_products.call_count == 2
+
+        with environ({'DATACUBE_CONFIG_PATH': str(config)}):
+            datacube_query.utils.cached_products_and_measurements()
+            datacube_query.utils.cached_products_and_measurements()
+            assert mock_get_products.call_count == 3
+
+            os.utime(str(config), (2, 2))  # Default config changed
+            datacube_query.utils.cached_products_and_measurements()
+            assert mock_get_products.call_count == 4
+
+    datacube_query.utils.cached_products_and_measurements.cache_clear()
+
+
+def test_cog_profile():
+    profile = {'driver': 'GTiff', 'width': 1024, 'height': 1024, 'count': 1, 'dtype': 'int16',
+               'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'compress': 'lzw',
+               'interleave': 'band', 'photometric': 'RGBA'}
+    ovr_options = {'resampling': 'average', 'factors': [2, 4, 8], 'internal_storage': True}
+
+    expected = {'driver': 'COG', 'width': 1024, 'height': 1024, 'count': 1, 'dtype': 'int16',
+                'blocksize': 256, 'compress': 'lzw', 'overviews': 'AUTO',
+                'overview_count': 3, 'overview_resampling': 'AVERAGE'}
+
+    assert datacube_query.utils.cog_profile(profile, ovr_options) == expected
+
+    expected = {'driver': 'COG', 'width': 1024, 'height': 1024, 'count': 1, 'dtype': 'int16',
+                'blocksize': 256, 'compress': 'lzw', 'overviews': 'NONE'}
+
+    assert datacube_query.utils.cog_profile(profile, ovr_options, overviews=False) == expected
 
 
 def test_datetime_to_str():
@@ -100,28 +116,26 @@ def test_datetime_to_str():
         datacube_query.utils.datetime_to_str(xrms)
 
 
+def test_datetimes_to_str():
+    dts = np.array(['2001-12-31T01:23:45.000000000', '2002-01-01T00:00:00.500000000'], dtype='datetime64[ns]')
+
+    assert list(datacube_query.utils.datetimes_to_str(dts)) == ['2001-12-31T01:23:45', '2002-01-01T00:00:00']
+    assert list(datacube_query.utils.datetimes_to_str(dts, 'D')) == ['2001-12-31', '2002-01-01']
+
+
 @patch('datacube.Datacube')
 def test_get_products_and_measurements(mock_datacube):
-    from datacube.utils.geometry import CRS
+    product = MagicMock()
+    product.name = 'some_dataset'
+    product.definition = {'name': 'some_dataset', 'description': 'Some Dataset'}
+    measurement = {'name': 'some_data', 'dtype': 'float32', 'nodata': -999, 'units': 'fm'}
+
+    empty_product = MagicMock()
+    empty_product.name = 'empty_dataset'
+    empty_product.definition = {'name': 'empty_dataset'}
+    empty_product.measurements = {}
 
-    products = {
-        'id': 42,
-        'name': {42: 'some_dataset'}, 'description': {42: 'Some Dataset'}, 'format': {42: 'NETCDF'},
-        'orbit': {42: np.nan}, 'time': {42: None}, 'lat': {42: np.nan}, 'platform': {42: 'HHG2U'},
-        'instrument': {42: 'a towel'}, 'product_type': {42: 'stuff'}, 'crs': {42: CRS('EPSG:4326')},
-        'resolution': {42: [-0.05, 0.05]}, 'tile_size': {42: None},
-        'spatial_dimensions': {42: ('latitude', 'longitude')}}
-
-    df_products = pd.DataFrame(products)
-    df_products.set_index(['id'])
-
-    measurements = {
-        'product': 'some_dataset', 'measurement': 'some_data',
-        'dtype': {('some_dataset', 'some_data'): 'float32'},
-        'name': {('some_dataset', 'some_data'): 'some_data'},
-        'nodata': {('some_dataset', 'some_data'): -999},
-        'spectral_definition': {('some_dataset', 'some_data'): np.nan},
-        'units': {('some_dataset', 'some_data'): 'fm'}}
+    mock_datacube().index.products.get_all.return_value = [product, empty_product]
 
     expected_with_aliases = {'Some Dataset (some_dataset)': {
         'product': 'some_dataset',
@@ -130,23 +144,11 @@ def test_get_products_and_measurements(mock_datacube):
         'product': 'some_dataset',
         'measurements': {'some_data': 'some_data'}}}
 
-    measurements_with_aliases = measurements.copy()
-    measurements_with_aliases['aliases'] = {('some_dataset', 'some_data'): ['foo','bar']}
-    df_measurements_with_aliases = pd.DataFrame(measurements_with_aliases)
-    df_measurements_with_aliases.set_index(['product','measurement'])
-
-    measurements_without_aliases = measurements.copy()
-    measurements_without_aliases['aliases'] = {('some_dataset', 'some_data'): np.nan}
-    df_measurements_without_aliases = pd.DataFrame(measurements_without_aliases)
-    df_measurements_without_aliases.set_index(['product','measurement'])
-
-    mock_datacube().list_products.return_value = pd.DataFrame(df_products)
-
-    mock_datacube().list_measurements.return_value = pd.DataFrame(df_measurements_with_aliases)
+    product.measurements = {'some_data': dict(measurement, aliases=['foo', 'bar'])}
     test_with_aliases = datacube_query.utils.get_products_and_measurements()
     assert test_with_aliases == expected_with_aliases
 
-    mock_datacube().list_measurements.return_value = pd.DataFrame(df_measurements_without_aliases)
+    product.measurements = {'some_data': measurement}
     test_without_aliases = datacube_query.utils.get_products_and_measurements()
     assert test_without_aliases == expected_without_aliases
 
@@ -168,11 +170,51 @@ def test_measurement_desc():
     assert datacube_query.utils.measurement_desc(measurement, list_aliases, True) == 'abc (def/ghi)'
 
 
+def test_quantize_dataset(fake_data_2x2x2):
+    data = xr.Dataset.from_dict(fake_data_2x2x2)
+
+    # int8 can't be quantized to a smaller dtype
+    assert datacube_query.utils.quantize_dataset(data) is None
+
+    data['FOO'] = (data['FOO'] * 0.5).astype(np.float32)
+    data['FOO'].attrs.update({'nodata': -1, 'valid_range': [0, 1], 'scale_factor': 0.0001})
+    test_data, scales, offsets = datacube_query.utils.quantize_dataset(data)
+
+    assert test_data.data_vars['FOO'].dtype == np.int16
+    assert (test_data.data_vars['FOO'] == 5000).all()
+    assert test_data.data_vars['FOO'].nodata == -1
+    assert scales == [0.0001]
+    assert offsets == [0]
+
+    # Out of range values are clipped, NaNs and nodata inside the valid range are remapped
+    data['FOO'] = xr.DataArray([[[np.nan, -999], [-0.0999, 2]], [[0, 0], [0, 0]]], dims=data['FOO'].dims,
+                               coords=data['FOO'].coords, attrs=data['FOO'].attrs).astype(np.float32)
+    data['FOO'].attrs.update({'nodata': -999, 'valid_range': [-1, 1]})
+    test_data, scales, offsets = datacube_query.utils.quantize_dataset(data)
+
+    assert test_data.data_vars['FOO'].nodata == np.iinfo(np.int16).min
+    assert test_data.data_vars['FOO'][0].values.tolist() == [[-32768, -32768], [-999, 10000]]
+    assert data['FOO'].nodata == -999  # Source attrs not modified
+
+    # Bands with different nodata share one packed nodata
+    data['BAR'] = (data['FOO'] * 0 + 0.5).astype(np.float32)
+    data['BAR'].attrs.update({'nodata': -1, 'valid_range': [0, 1], 'scale_factor': 0.0001})
+    test_data, scales, offsets = datacube_query.utils.quantize_dataset(data)
+
+    assert test_data.data_vars['FOO'].nodata == test_data.data_vars['BAR'].nodata == np.iinfo(np.int16).min
+    assert scales == [0.0001, 0.0001]
+    data = data.drop_vars('BAR')
+
+    # valid_range doesn't fit in an int16
+    data['FOO'].attrs['scale_factor'] = 0.00001
+    assert datacube_query.utils.quantize_dataset(data) is None
+
+
 @patch('datacube.Datacube')
 def test_run_query_no_datasets(mock_datacube):
     from datacube_query.exceptions import NoDataError
 
-    mock_datacube().index.datasets.search_eager.return_value = None
+    mock_datacube().find_datasets.return_value = None
 
     query = {'product': 'tma', 'measurements': ['1', '4', '9'],
              'x': (19680402.0, 19680205.0), 'y': (-19680205.0, -19680402.0),
@@ -200,7 +242,7 @@ def test_run_query_no_data(mock_datacube):
 def test_run_query_too_many_datasets(mock_datacube):
     from datacube_query.exceptions import TooManyDatasetsError
 
-    mock_datacube().index.datasets.search_eager.return_value = [1] * 3
+    mock_datacube().find_datasets.return_value = [1] * 3
 
     query = {'product': 'tma', 'measurements': ['1', '4', '9'],
              'x': (19680402.0, 19680205.0), 'y': (-19680205.0, -19680402.0),
@@ -231,6 +273,44 @@ def test_run_query_with_data(mock_datacube):
     assert mock_dataset.identical(datacube_query.utils.run_query(query))
 
 
+@patch('datacube.Datacube')
+def test_run_query_reuses_datasets(mock_datacube):
+    datasets = [1, 2, 3]
+    mock_datacube().find_datasets.return_value = datasets
+
+    query = {'product': 'tma', 'measurements': ['1', '4', '9'],
+             'x': (19680402.0, 19680205.0), 'y': (-19680205.0, -19680402.0),
+             'time': ['2001-01-01', '2001-12-31'], 'crs': 'EPSG:4283'}
+
+    datacube_query.utils.run_query(query)
+
+    mock_datacube().find_datasets.assert_called_once_with(
+        ensure_location=True, product='tma', time=['2001-01-01', '2001-12-31'],
+        x=(19680402.0, 19680205.0), y=(-19680205.0, -19680402.0), crs='EPSG:4283')
+    mock_datacube().load.assert_called_once_with(datasets=datasets, **query)
+
+
+@patch('datacube.Datacube')
+def test_run_query_y_chunks(mock_datacube):
+    from datacube.utils.geometry import CRS
+
+    dataset = MagicMock()
+    dataset.crs = CRS('EPSG:4326')
+    mock_datacube().find_datasets.return_value = [dataset]
+
+    query = {'product': 'tma', 'measurements': ['1', '4', '9'],
+             'x': (140.0, 141.0), 'y': (-36.0, -35.0),
+             'time': ['2001-01-01', '2001-12-31'], 'crs': 'EPSG:4326',
+             'dask_chunks': {'time': 1, 'y': 2048}}
+
+    datacube_query.utils.run_query(query)
+    assert mock_datacube().load.call_args[1]['dask_chunks'] == {'time': 1, 'latitude': 2048}
+
+    query.update({'output_crs': 'EPSG:3577', 'resolution': [25, 25]})
+    datacube_query.utils.run_query(query)
+    assert mock_datacube().load.call_args[1]['dask_chunks'] == {'time': 1, 'y': 2048}
+
+
 @patch('datacube.Datacube')
 def test_run_query_with_dodgy_crs(mock_datacube, shut_gdal_up):
     query = {'product': 'tma', 'measurements': ['1', '4', '9'],
@@ -252,10 +332,6 @@ def test_upcast(fake_data_2x2x2):
     assert test_data.crs
 
 
-def test_update_tags():
-    pass  # tested implicitly in test_build_overviews
-
-
 def test_write_geotiff(fake_data_2x2x2):
 
     data = xr.Dataset.from_dict(fake_data_2x2x2)
@@ -264,5 +340,89 @@ def test_write_geotiff(fake_data_2x2x2):
         datacube_query.utils.write_geotiff(data, path, time_index=0)
 
         assert path.exists()
+        with rio.open(str(path)) as raster:
+            assert raster.descriptions == ('FOO',)
+            assert raster.nodata == -1
+
+
+def test_write_geotiff_tags_overviews_stats(fake_data_2x2x2):
+
+    data = xr.Dataset.from_dict(fake_data_2x2x2)
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir, 'test.tif')
+        datacube_query.utils.write_geotiff(data, path, time_index=0,
+                                           tags={'TIFFTAG_DATETIME': '2001:01:31'},
+                                           overviews=True, overview_options={'factors': [2]},
+                                           calc_stats=True, approx_ok=False)
+
+        with rio.open(str(path)) as raster:
+            assert raster.tags()['TIFFTAG_DATETIME'] == '2001:01:31'
+            assert raster.overviews(1) == [2]
+            assert raster.tags(ns='rio_overview')['resampling'] == 'average'
+            assert 'STATISTICS_MEAN' in raster.tags(1)
+
+
+def test_write_geotiff_cog_unsupported_resampling(fake_data_2x2x2):
+
+    data = xr.Dataset.from_dict(fake_data_2x2x2)
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir, 'test.tif')
+        datacube_query.utils.write_geotiff(data, path, time_index=0, profile_override={'driver': 'COG'},
+                                           overviews=True, overview_options={'factors': [2], 'resampling': 'gauss'})
+
+        with rio.open(str(path)) as raster:  # Fell back to GTiff
+            assert raster.tags(ns='IMAGE_STRUCTURE').get('LAYOUT') != 'COG'
+            assert raster.overviews(1) == [2]
+            assert raster.tags(ns='rio_overview')['resampling'] == 'gauss'
 
 
+def test_write_geotiff_chunked(fake_data_2x2x2):
+
+    data = xr.Dataset.from_dict(fake_data_2x2x2).chunk({'time': 1, 'y': 1})
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir, 'test.tif')
+        datacube_query.utils.write_geotiff(data, path, time_index=0)
+
+        with rio.open(str(path)) as raster:
+            assert (raster.read(1) == 1).all()
+
+
+def test_write_geotiff_cog(fake_data_2x2x2):
+
+    data = xr.Dataset.from_dict(fake_data_2x2x2)
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir, 'test.tif')
+        datacube_query.utils.write_geotiff(data, path, time_index=0, profile_override={'driver': 'COG'},
+                                           overviews=True, overview_options={'factors': [2]})
+
+        with rio.open(str(path)) as raster:
+            assert raster.tags(ns='IMAGE_STRUCTURE')['LAYOUT'] == 'COG'
+            assert raster.overviews(1) == [2]
+
+
+def test_write_geotiff_quantize(fake_data_2x2x2):
+
+    data = xr.Dataset.from_dict(fake_data_2x2x2)
+    data['FOO'] = (data['FOO'] * 0.5).astype(np.float32)
+    data['FOO'].attrs.update({'nodata': -1, 'valid_range': [0, 1], 'scale_factor': 0.0001, 'add_offset': 0})
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir, 'test.tif')
+        datacube_query.utils.write_geotiff(data, path, time_index=0, quantize=True)
+
+        with rio.open(str(path)) as raster:
+            assert raster.dtypes == ('int16',)
+            assert raster.nodata == -1
+            assert raster.scales == (0.0001,)
+            assert raster.offsets == (0.0,)
+            assert (raster.read(1) == 5000).all()
+
+
+def test_write_geotiff_profile_override_case(fake_data_2x2x2):
+
+    data = xr.Dataset.from_dict(fake_data_2x2x2)
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir, 'test.tif')
+        datacube_query.utils.write_geotiff(data, path, time_index=0, profile_override={'COMPRESS': 'deflate'})
+
+        with rio.open(str(path)) as raster:
+            assert raster.compression.value == 'DEFLATE'